@@ -1,6 +1,12 @@
+import math
 import torch
 from torch import nn
-from torch.distributions.categorical import Categorical
+from torch.nn import functional as F
+try:
+    import numba # optional, compiles compute_tour_length(..., use_numba=True) for CPU tensors
+    import numpy as np
+except ImportError:
+    numba = None
 
 class Transformer_encoder_net(nn.Module):
     """
@@ -9,12 +15,13 @@ class Transformer_encoder_net(nn.Module):
       h of size      (bsz, nb_nodes+1, dim_emb)    batch of input cities
     Outputs :  
       h of size      (bsz, nb_nodes+1, dim_emb)    batch of encoded cities
-      score of size  (bsz, nb_nodes+1, nb_nodes+1) batch of attention scores
+      score is None                                attention scores are not computed, so that nn.MultiheadAttention 
+                                                   can use its fast path and fused attention kernels
     """
     def __init__(self, nb_layers, dim_emb, nb_heads, dim_ff, batchnorm):
         super(Transformer_encoder_net, self).__init__()
         assert dim_emb == nb_heads* (dim_emb//nb_heads) # check if dim_emb is divisible by nb_heads
-        self.MHA_layers = nn.ModuleList( [nn.MultiheadAttention(dim_emb, nb_heads) for _ in range(nb_layers)] )
+        self.MHA_layers = nn.ModuleList( [nn.MultiheadAttention(dim_emb, nb_heads, batch_first=True) for _ in range(nb_layers)] )
         self.linear1_layers = nn.ModuleList( [nn.Linear(dim_emb, dim_ff) for _ in range(nb_layers)] )
         self.linear2_layers = nn.ModuleList( [nn.Linear(dim_ff, dim_emb) for _ in range(nb_layers)] )   
         if batchnorm:
@@ -28,99 +35,86 @@ class Transformer_encoder_net(nn.Module):
         self.batchnorm = batchnorm
         
     def forward(self, h):      
-        # PyTorch nn.MultiheadAttention requires input size (seq_len, bsz, dim_emb) 
-        h = h.transpose(0,1) # size(h)=(nb_nodes, bsz, dim_emb)  
+        # h is kept in batch-first layout, nn.MultiheadAttention is built with batch_first=True
+        bsz, nb_nodes, dim_emb = h.size()
         # L layers
         for i in range(self.nb_layers):
-            h_rc = h # residual connection, size(h_rc)=(nb_nodes, bsz, dim_emb)
-            h, score = self.MHA_layers[i](h, h, h) # size(h)=(nb_nodes, bsz, dim_emb), size(score)=(bsz, nb_nodes, nb_nodes)
+            h_rc = h # residual connection, size(h_rc)=(bsz, nb_nodes, dim_emb)
+            h, _ = self.MHA_layers[i](h, h, h, need_weights=False) # size(h)=(bsz, nb_nodes, dim_emb)
             # add residual connection
-            h = h_rc + h # size(h)=(nb_nodes, bsz, dim_emb)
+            h = h_rc + h # size(h)=(bsz, nb_nodes, dim_emb)
             if self.batchnorm:
-                # Pytorch nn.BatchNorm1d requires input size (bsz, dim, seq_len)
-                h = h.permute(1,2,0).contiguous() # size(h)=(bsz, dim_emb, nb_nodes)
-                h = self.norm1_layers[i](h)       # size(h)=(bsz, dim_emb, nb_nodes)
-                h = h.permute(2,0,1).contiguous() # size(h)=(nb_nodes, bsz, dim_emb)
+                # Pytorch nn.BatchNorm1d normalizes each of the dim_emb features over the first dimension of a (bsz*nb_nodes, dim_emb) input
+                h = self.norm1_layers[i](h.reshape(bsz*nb_nodes, dim_emb)) # size(h)=(bsz*nb_nodes, dim_emb)
+                h = h.view(bsz, nb_nodes, dim_emb) # size(h)=(bsz, nb_nodes, dim_emb)
             else:
-                h = self.norm1_layers[i](h)       # size(h)=(nb_nodes, bsz, dim_emb) 
+                h = self.norm1_layers[i](h)       # size(h)=(bsz, nb_nodes, dim_emb) 
             # feedforward
             h_rc = h # residual connection
             h = self.linear2_layers[i](torch.relu(self.linear1_layers[i](h)))
-            h = h_rc + h # size(h)=(nb_nodes, bsz, dim_emb)
+            h = h_rc + h # size(h)=(bsz, nb_nodes, dim_emb)
             if self.batchnorm:
-                h = h.permute(1,2,0).contiguous() # size(h)=(bsz, dim_emb, nb_nodes)
-                h = self.norm2_layers[i](h)       # size(h)=(bsz, dim_emb, nb_nodes)
-                h = h.permute(2,0,1).contiguous() # size(h)=(nb_nodes, bsz, dim_emb)
+                h = self.norm2_layers[i](h.reshape(bsz*nb_nodes, dim_emb)) # size(h)=(bsz*nb_nodes, dim_emb)
+                h = h.view(bsz, nb_nodes, dim_emb) # size(h)=(bsz, nb_nodes, dim_emb)
             else:
-                h = self.norm2_layers[i](h) # size(h)=(nb_nodes, bsz, dim_emb)
-        # Transpose h
-        h = h.transpose(0,1) # size(h)=(bsz, nb_nodes, dim_emb)
-        return h, score
+                h = self.norm2_layers[i](h) # size(h)=(bsz, nb_nodes, dim_emb)
+        return h, None
     
 
-def myMHA(Q, K, V, nb_heads, mask=None, clip_value=None):
+def myMHA(Q, K, V, nb_heads, mask=None):
     """
     Compute multi-head attention (MHA) given a query Q, key K, value V and attention mask :
       h = Concat_{k=1}^nb_heads softmax(Q_k^T.K_k).V_k 
     Note : We did not use nn.MultiheadAttention to avoid re-computing all linear transformations at each call.
-    Inputs : Q of size (bsz, dim_emb, 1)                batch of queries
-             K of size (bsz, dim_emb, nb_nodes+1)       batch of keys
-             V of size (bsz, dim_emb, nb_nodes+1)       batch of values
-             mask of size (bsz, nb_nodes+1)             batch of masks of visited cities
-             clip_value is a scalar 
-    Outputs : attn_output of size (bsz, 1, dim_emb)     batch of attention vectors
-              attn_weights of size (bsz, 1, nb_nodes+1) batch of attention weights
+    Inputs : Q of size (bsz, nb_queries, dim_emb)       batch of queries (nb_queries=B beams in beam search, 1 otherwise)
+             K of size (bsz, nb_nodes+1, dim_emb)       batch of keys, shared by the queries of a batch,
+                    or (bsz, nb_heads or 1, nb_nodes+1, dim_emb//nb_heads) if already split into heads
+             V of size (bsz, nb_nodes+1, dim_emb)       batch of values, shared by the queries of a batch,
+                    or (bsz, nb_heads or 1, nb_nodes+1, dim_emb//nb_heads) if already split into heads
+             mask of size (bsz, nb_nodes+1) or (bsz, nb_queries, nb_nodes+1) batch of masks of visited cities
+    Output : attn_output of size (bsz, nb_queries, dim_emb)     batch of attention vectors
     """
-    bsz, nb_nodes, emd_dim = K.size() #  dim_emb must be divisable by nb_heads
-    if nb_heads>1:
-        # PyTorch view requires contiguous dimensions for correct reshaping
-        Q = Q.transpose(1,2).contiguous() # size(Q)=(bsz, dim_emb, 1)
-        Q = Q.view(bsz*nb_heads, emd_dim//nb_heads, 1) # size(Q)=(bsz*nb_heads, dim_emb//nb_heads, 1)
-        Q = Q.transpose(1,2).contiguous() # size(Q)=(bsz*nb_heads, 1, dim_emb//nb_heads)
-        K = K.transpose(1,2).contiguous() # size(K)=(bsz, dim_emb, nb_nodes+1)
-        K = K.view(bsz*nb_heads, emd_dim//nb_heads, nb_nodes) # size(K)=(bsz*nb_heads, dim_emb//nb_heads, nb_nodes+1)
-        K = K.transpose(1,2).contiguous() # size(K)=(bsz*nb_heads, nb_nodes+1, dim_emb//nb_heads)
-        V = V.transpose(1,2).contiguous() # size(V)=(bsz, dim_emb, nb_nodes+1)
-        V = V.view(bsz*nb_heads, emd_dim//nb_heads, nb_nodes) # size(V)=(bsz*nb_heads, dim_emb//nb_heads, nb_nodes+1)
-        V = V.transpose(1,2).contiguous() # size(V)=(bsz*nb_heads, nb_nodes+1, dim_emb//nb_heads)
-    attn_weights = torch.bmm(Q, K.transpose(1,2))/ Q.size(-1)**0.5 # size(attn_weights)=(bsz*nb_heads, 1, nb_nodes+1)
-    if clip_value is not None:
-        attn_weights = clip_value * torch.tanh(attn_weights)
+    bsz, nb_queries, emd_dim = Q.size() #  dim_emb must be divisable by nb_heads
+    d_h = emd_dim//nb_heads
+    # split the heads without copy
+    Q = Q.view(bsz, nb_queries, nb_heads, d_h).transpose(1,2) # size(Q)=(bsz, nb_heads, nb_queries, dim_emb//nb_heads)
+    if K.dim()==3:
+        K = K.view(bsz, -1, nb_heads, d_h).transpose(1,2) # size(K)=(bsz, nb_heads, nb_nodes+1, dim_emb//nb_heads)
+        V = V.view(bsz, -1, nb_heads, d_h).transpose(1,2) # size(V)=(bsz, nb_heads, nb_nodes+1, dim_emb//nb_heads)
+    elif K.size(1)==1 and nb_heads>1:
+        # a single key/value head shared by all query heads (multi-query attention), broadcast without copy
+        K = K.expand(-1, nb_heads, -1, -1) # size(K)=(bsz, nb_heads, nb_nodes+1, dim_emb//nb_heads)
+        V = V.expand(-1, nb_heads, -1, -1) # size(V)=(bsz, nb_heads, nb_nodes+1, dim_emb//nb_heads)
+    nb_nodes = K.size(2)
     if mask is not None:
-        if nb_heads>1:
-            mask = torch.repeat_interleave(mask, repeats=nb_heads, dim=0) # size(mask)=(bsz*nb_heads, nb_nodes+1)
-        #attn_weights = attn_weights.masked_fill(mask.unsqueeze(1), float('-inf')) # size(attn_weights)=(bsz*nb_heads, 1, nb_nodes+1)
-        attn_weights = attn_weights.masked_fill(mask.unsqueeze(1), float('-1e9')) # size(attn_weights)=(bsz*nb_heads, 1, nb_nodes+1)
-    attn_weights = torch.softmax(attn_weights, dim=-1) # size(attn_weights)=(bsz*nb_heads, 1, nb_nodes+1)
-    attn_output = torch.bmm(attn_weights, V) # size(attn_output)=(bsz*nb_heads, 1, dim_emb//nb_heads)
-    if nb_heads>1:
-        attn_output = attn_output.transpose(1,2).contiguous() # size(attn_output)=(bsz*nb_heads, dim_emb//nb_heads, 1)
-        attn_output = attn_output.view(bsz, emd_dim, 1) # size(attn_output)=(bsz, dim_emb, 1)
-        attn_output = attn_output.transpose(1,2).contiguous() # size(attn_output)=(bsz, 1, dim_emb)
-        attn_weights = attn_weights.view(bsz, nb_heads, 1, nb_nodes) # size(attn_weights)=(bsz, nb_heads, 1, nb_nodes+1)
-        attn_weights = attn_weights.mean(dim=1) # mean over the heads, size(attn_weights)=(bsz, 1, nb_nodes+1)
-    return attn_output, attn_weights
+        mask = mask.view(bsz, 1, -1, nb_nodes) # broadcast over the heads (and the queries), size(mask)=(bsz, 1, 1 or nb_queries, nb_nodes+1)
+    # fused attention : scores, masking, softmax and weighted sum of values in a single call, attention weights are not materialized
+    attn_mask = ~mask if mask is not None else None # True for cities that can be attended
+    attn_output = F.scaled_dot_product_attention(Q, K, V, attn_mask=attn_mask) # size(attn_output)=(bsz, nb_heads, nb_queries, dim_emb//nb_heads)
+    attn_output = attn_output.transpose(1,2).reshape(bsz, nb_queries, emd_dim) # size(attn_output)=(bsz, nb_queries, dim_emb)
+    return attn_output
     
     
 class AutoRegressiveDecoderLayer(nn.Module):
     """
     Single decoder layer based on self-attention and query-attention
     Inputs :  
-      h_t of size      (bsz, 1, dim_emb)          batch of input queries
-      K_att of size    (bsz, nb_nodes+1, dim_emb) batch of query-attention keys
-      V_att of size    (bsz, nb_nodes+1, dim_emb) batch of query-attention values
-      mask of size     (bsz, nb_nodes+1)          batch of masks of visited cities
+      h_t of size      (bsz*B, 1, dim_emb)                            batch of input queries (B=1 without beam search)
+      K_att of size    (bsz, nb_heads, nb_nodes+1, dim_emb//nb_heads) batch of query-attention keys, shared by the B beams
+      V_att of size    (bsz, nb_heads, nb_nodes+1, dim_emb//nb_heads) batch of query-attention values, shared by the B beams
+      mask of size     (bsz*B, nb_nodes+1)        batch of masks of visited cities
     Output :  
       h_t of size (bsz, nb_nodes+1)               batch of transformed queries
     """
-    def __init__(self, dim_emb, nb_heads, segm_len):
+    def __init__(self, dim_emb, nb_heads, segm_len, multi_query=False):
         super(AutoRegressiveDecoderLayer, self).__init__()
         self.dim_emb = dim_emb
         self.nb_heads = nb_heads
         self.segm_len = segm_len
-        self.Wq_selfatt = nn.Linear(dim_emb, dim_emb)
-        self.Wk_selfatt = nn.Linear(dim_emb, dim_emb)
-        self.Wv_selfatt = nn.Linear(dim_emb, dim_emb)
+        self.multi_query = multi_query
+        # size of the self-attention keys and values, with multi-query attention a single key/value head is shared by all query heads
+        self.dim_kv = dim_emb//nb_heads if multi_query else dim_emb
+        self.W_qkv_selfatt = nn.Linear(dim_emb, dim_emb+ 2* self.dim_kv) # query, key and value of self-attention in a single linear layer
         self.W0_selfatt = nn.Linear(dim_emb, dim_emb)
         self.W0_att = nn.Linear(dim_emb, dim_emb)
         self.Wq_att = nn.Linear(dim_emb, dim_emb)
@@ -131,63 +125,87 @@ class AutoRegressiveDecoderLayer(nn.Module):
         self.BN_MLP = nn.LayerNorm(dim_emb)
         self.K_sa = None
         self.V_sa = None
+        self.cur_len = 0
+        self.cache_len = None
 
-    def reset_selfatt_keys_values(self):
+    # Load checkpoints saved with separate Wq_selfatt, Wk_selfatt and Wv_selfatt layers
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        if prefix + 'Wq_selfatt.weight' in state_dict:
+            for name in ['weight', 'bias']:
+                state_dict[prefix + 'W_qkv_selfatt.' + name] = torch.cat([state_dict.pop(prefix + W + '.' + name) for W in ['Wq_selfatt', 'Wk_selfatt', 'Wv_selfatt']], dim=0)
+        super(AutoRegressiveDecoderLayer, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    # Reset self-attention keys and values when decoding starts
+    # max_len is the number of decoding steps, i.e. the length of the preallocated key/value buffers
+    def reset_selfatt_keys_values(self, max_len):
         self.K_sa = None
         self.V_sa = None
+        self.cur_len = 0
+        self.cache_len = max_len if self.segm_len is None else min(max_len, self.segm_len)
         
-    # For beam search
-    def reorder_selfatt_keys_values(self, t, idx_top_beams):
-        if self.segm_len is not None:
-            key_len = min(self.segm_len, t+1)
+    # Copy the written rows of a key/value buffer of size (bsz*B2, cache_len, dim_kv) into a new buffer of size (bsz*B, cache_len, dim_kv)
+    # idx of size (bsz, B, key_len, dim_kv) selects the beams of the new buffer, None broadcasts the single beam (B2=1) of each batch
+    def _copy_written_rows(self, buffer, bsz, B, idx=None):
+        key_len = min(self.cur_len, self.cache_len) # rows beyond key_len have not been written yet
+        src = buffer.view(bsz, -1, self.cache_len, self.dim_kv)[:, :, :key_len] # size(src)=(bsz, B2, key_len, dim_kv)
+        new_buffer = buffer.new_empty(bsz*B, self.cache_len, self.dim_kv) # size(new_buffer)=(bsz*B, cache_len, dim_kv)
+        dst = new_buffer.view(bsz, B, self.cache_len, self.dim_kv)[:, :, :key_len] # size(dst)=(bsz, B, key_len, dim_kv)
+        if idx is None:
+            dst.copy_(src.expand(bsz, B, key_len, self.dim_kv))
+        elif torch.is_grad_enabled():
+            dst.copy_(src.gather(1, idx)) # out= does not support autograd
         else:
-            key_len = t+1
-            
+            torch.gather(src, 1, idx, out=dst)
+        return new_buffer
+
+    # For beam search
+    def reorder_selfatt_keys_values(self, idx_top_beams):
         bsz, B = idx_top_beams.size()
-        zero_to_B = torch.arange(B, device=idx_top_beams.device) # [0,1,...,B-1]
-        B2 = self.K_sa.size(0)// bsz
-        self.K_sa = self.K_sa.view(bsz, B2, key_len, self.dim_emb) # size(self.K_sa)=(bsz, B2, t+1, dim_emb)
-        K_sa_tmp = self.K_sa.clone()
-        self.K_sa = torch.zeros(bsz, B, key_len, self.dim_emb, device=idx_top_beams.device)
-        for b in range(bsz):
-            self.K_sa[b, zero_to_B, :, :] = K_sa_tmp[b, idx_top_beams[b], :, :]
-        self.K_sa = self.K_sa.view(bsz*B, key_len, self.dim_emb) # size(self.K_sa)=(bsz*B, t+1, dim_emb)
-        self.V_sa = self.V_sa.view(bsz, B2, key_len, self.dim_emb) # size(self.K_sa)=(bsz, B, t+1, dim_emb)
-        V_sa_tmp = self.V_sa.clone()
-        self.V_sa = torch.zeros(bsz, B, key_len, self.dim_emb, device=idx_top_beams.device)
-        for b in range(bsz):
-            self.V_sa[b, zero_to_B, :, :] = V_sa_tmp[b, idx_top_beams[b], :, :]
-        self.V_sa = self.V_sa.view(bsz*B, key_len, self.dim_emb) # size(self.K_sa)=(bsz*B, t+1, dim_emb)
+        key_len = min(self.cur_len, self.cache_len)
+        idx = idx_top_beams.view(bsz, B, 1, 1).expand(bsz, B, key_len, self.dim_kv) # size(idx)=(bsz, B, key_len, dim_kv)
+        self.K_sa = self._copy_written_rows(self.K_sa, bsz, B, idx) # size(self.K_sa)=(bsz*B, cache_len, dim_kv)
+        self.V_sa = self._copy_written_rows(self.V_sa, bsz, B, idx) # size(self.V_sa)=(bsz*B, cache_len, dim_kv)
 
     # For beam search
     def repeat_selfatt_keys_values(self, B):
-        self.K_sa = torch.repeat_interleave(self.K_sa, B, dim=0) # size(self.K_sa)=(bsz.B, t+1, dim_emb)
-        self.V_sa = torch.repeat_interleave(self.V_sa, B, dim=0) # size(self.K_sa)=(bsz.B, t+1, dim_emb)
+        bsz = self.K_sa.size(0)
+        self.K_sa = self._copy_written_rows(self.K_sa, bsz, B) # size(self.K_sa)=(bsz.B, cache_len, dim_kv)
+        self.V_sa = self._copy_written_rows(self.V_sa, bsz, B) # size(self.V_sa)=(bsz.B, cache_len, dim_kv)
         
     def forward(self, h_t, K_att, V_att, mask):
         bsz = h_t.size(0)
         h_t = h_t.view(bsz,1,self.dim_emb) # size(h_t)=(bsz, 1, dim_emb)
         # embed the query for self-attention
-        q_sa = self.Wq_selfatt(h_t) # size(q_sa)=(bsz, 1, dim_emb)
-        k_sa = self.Wk_selfatt(h_t) # size(k_sa)=(bsz, 1, dim_emb)
-        v_sa = self.Wv_selfatt(h_t) # size(v_sa)=(bsz, 1, dim_emb)
-        # concatenate the new self-attention key and value to the previous keys and values
+        q_sa, k_sa, v_sa = self.W_qkv_selfatt(h_t).split([self.dim_emb, self.dim_kv, self.dim_kv], dim=-1) # size(q_sa)=(bsz, 1, dim_emb), size(k_sa)=size(v_sa)=(bsz, 1, dim_kv)
+        # write the new self-attention key and value into the preallocated buffers
+        # with segm_len, the buffers are used as a ring buffer of the segm_len latest keys and values (attention does not depend on their order)
         if self.K_sa is None:
-            self.K_sa = k_sa # size(self.K_sa)=(bsz, 1, dim_emb)
-            self.V_sa = v_sa # size(self.V_sa)=(bsz, 1, dim_emb)
-        else:
-            self.K_sa = torch.cat([self.K_sa, k_sa], dim=1)
-            self.V_sa = torch.cat([self.V_sa, v_sa], dim=1)
-        if self.segm_len is not None:
-            self.K_sa = self.K_sa[:, -self.segm_len:, :]
-            self.V_sa = self.V_sa[:, -self.segm_len:, :]
+            self.K_sa = k_sa.new_empty(bsz, self.cache_len, self.dim_kv) # size(self.K_sa)=(bsz, cache_len, dim_kv)
+            self.V_sa = v_sa.new_empty(bsz, self.cache_len, self.dim_kv) # size(self.V_sa)=(bsz, cache_len, dim_kv)
+        pos = self.cur_len % self.cache_len
+        self.K_sa[:, pos, :] = k_sa.squeeze(1)
+        self.V_sa[:, pos, :] = v_sa.squeeze(1)
+        self.cur_len += 1
+        key_len = min(self.cur_len, self.cache_len)
+        K_sa = self.K_sa[:, :key_len, :] # size(K_sa)=(bsz, key_len, dim_kv)
+        V_sa = self.V_sa[:, :key_len, :] # size(V_sa)=(bsz, key_len, dim_kv)
+        if torch.is_grad_enabled():
+            # the buffers are overwritten in-place at the next step, so their views must not be saved for backward
+            K_sa = K_sa.clone()
+            V_sa = V_sa.clone()
+        if self.multi_query:
+            K_sa = K_sa.unsqueeze(1) # single head, size(K_sa)=(bsz, 1, key_len, dim_kv)
+            V_sa = V_sa.unsqueeze(1) # single head, size(V_sa)=(bsz, 1, key_len, dim_kv)
         # compute self-attention between nodes in the partial tour
-        h_t = h_t + self.W0_selfatt( myMHA(q_sa, self.K_sa, self.V_sa, self.nb_heads)[0] ) # size(h_t)=(bsz, 1, dim_emb)
+        h_t = h_t + self.W0_selfatt( myMHA(q_sa, K_sa, V_sa, self.nb_heads) ) # size(h_t)=(bsz, 1, dim_emb)
         h_t = self.BN_selfatt(h_t.squeeze()) # size(h_t)=(bsz, dim_emb)
         h_t = h_t.view(bsz, 1, self.dim_emb) # size(h_t)=(bsz, 1, dim_emb)
         # compute attention between self-attention nodes and encoding nodes in the partial tour (translation process)
-        q_a = self.Wq_att(h_t) # size(q_a)=(bsz, 1, dim_emb)
-        h_t = h_t + self.W0_att( myMHA(q_a, K_att, V_att, self.nb_heads, mask)[0] ) # size(h_t)=(bsz, 1, dim_emb)
+        # the B beams of a batch are queries of the same keys and values
+        bsz_att = K_att.size(0)
+        q_a = self.Wq_att(h_t).view(bsz_att, bsz//bsz_att, self.dim_emb) # size(q_a)=(bsz/B, B, dim_emb)
+        attn_output = myMHA(q_a, K_att, V_att, self.nb_heads, mask.view(bsz_att, bsz//bsz_att, -1)) # size(attn_output)=(bsz/B, B, dim_emb)
+        h_t = h_t + self.W0_att( attn_output.view(bsz, 1, self.dim_emb) ) # size(h_t)=(bsz, 1, dim_emb)
         h_t = self.BN_att(h_t.squeeze()) # size(h_t)=(bsz, dim_emb)
         h_t = h_t.view(bsz, 1, self.dim_emb) # size(h_t)=(bsz, 1, dim_emb)
         # MLP
@@ -200,49 +218,70 @@ class Transformer_decoder_net(nn.Module):
     """
     Decoder network based on self-attention and query-attention transformers
     Inputs :  
-      h_t of size      (bsz, 1, dim_emb)                            batch of input queries
-      K_att of size    (bsz, nb_nodes+1, dim_emb*nb_layers_decoder) batch of query-attention keys for all decoding layers
-      V_att of size    (bsz, nb_nodes+1, dim_emb*nb_layers_decoder) batch of query-attention values for all decoding layers
-      mask of size     (bsz, nb_nodes+1)                            batch of masks of visited cities
+      h_t of size      (bsz*B, 1, dim_emb)                          batch of input queries (B=1 without beam search)
+      K_att is a list of nb_layers_decoder tensors          batch of query-attention keys of each decoding layer, shared by the B beams,
+                                                            split into heads by split_keys_values()
+      V_att is a list of nb_layers_decoder tensors          batch of query-attention values of each decoding layer, shared by the B beams
+                                                            split into heads by split_keys_values()
+      mask of size     (bsz*B, nb_nodes+1)                          batch of masks of visited cities
     Output :  
-      prob_next_node of size (bsz, nb_nodes+1)                      batch of probabilities of next node
+      log_prob_next_node of size (bsz*B, nb_nodes+1)                batch of log probabilities of next node
     """
-    def __init__(self, dim_emb, nb_heads, nb_layers_decoder, segm_len):
+    def __init__(self, dim_emb, nb_heads, nb_layers_decoder, segm_len, multi_query=False):
         super(Transformer_decoder_net, self).__init__()
         self.dim_emb = dim_emb
         self.nb_heads = nb_heads
         self.nb_layers_decoder = nb_layers_decoder
-        self.decoder_layers = nn.ModuleList( [AutoRegressiveDecoderLayer(dim_emb, nb_heads, segm_len) for _ in range(nb_layers_decoder-1)] )
+        self.decoder_layers = nn.ModuleList( [AutoRegressiveDecoderLayer(dim_emb, nb_heads, segm_len, multi_query) for _ in range(nb_layers_decoder-1)] )
         self.Wq_final = nn.Linear(dim_emb, dim_emb)
         
-    # Reset to None self-attention keys and values when decoding starts 
-    def reset_selfatt_keys_values(self): 
+    # Reset self-attention keys and values when decoding starts, max_len is the number of decoding steps
+    def reset_selfatt_keys_values(self, max_len): 
         for l in range(self.nb_layers_decoder-1):
-            self.decoder_layers[l].reset_selfatt_keys_values()
+            self.decoder_layers[l].reset_selfatt_keys_values(max_len)
             
     # For beam search
-    def reorder_selfatt_keys_values(self, t, idx_top_beams):
+    def reorder_selfatt_keys_values(self, idx_top_beams):
         for l in range(self.nb_layers_decoder-1):
-            self.decoder_layers[l].reorder_selfatt_keys_values(t, idx_top_beams)
+            self.decoder_layers[l].reorder_selfatt_keys_values(idx_top_beams)
     
     # For beam search
     def repeat_selfatt_keys_values(self, B):
         for l in range(self.nb_layers_decoder-1):
             self.decoder_layers[l].repeat_selfatt_keys_values(B)
+            
+    # Split the query-attention keys and values into the heads of each decoding layer, once before decoding starts
+    #   K_att, V_att of size (bsz, nb_nodes+1, dim_emb*nb_layers_decoder)
+    def split_keys_values(self, K_att, V_att):
+        bsz, nb_nodes = K_att.size(0), K_att.size(1)
+        L = self.nb_layers_decoder-1 # intermediate layers
+        d_h = self.dim_emb//self.nb_heads
+        # intermediate layers : a single copy into (L, bsz, nb_heads, nb_nodes+1, dim_emb//nb_heads), unbound into L contiguous tensors
+        K_att_list = list( K_att[:,:,:L*self.dim_emb].view(bsz, nb_nodes, L, self.nb_heads, d_h).permute(2,0,3,1,4).contiguous().unbind(0) )
+        V_att_list = list( V_att[:,:,:L*self.dim_emb].view(bsz, nb_nodes, L, self.nb_heads, d_h).permute(2,0,3,1,4).contiguous().unbind(0) )
+        # final layer with a single head, size(K_att_final)=(bsz, 1, nb_nodes+1, dim_emb)
+        K_att_list.append( K_att[:,:,L*self.dim_emb:].view(bsz, nb_nodes, 1, self.dim_emb).transpose(1,2).contiguous() )
+        V_att_list.append( V_att[:,:,L*self.dim_emb:].view(bsz, nb_nodes, 1, self.dim_emb).transpose(1,2) ) # not used by the final layer, no copy
+        return K_att_list, V_att_list
      
     def forward(self, h_t, K_att, V_att, mask):
+        bsz = K_att[0].size(0)
+        B = h_t.size(0)// bsz # number of beams sharing the keys and values of a batch
         for l in range(self.nb_layers_decoder):
-            K_att_l = K_att[:,:,l*self.dim_emb:(l+1)*self.dim_emb].contiguous()  # size(K_att_l)=(bsz, nb_nodes+1, dim_emb)
-            V_att_l = V_att[:,:,l*self.dim_emb:(l+1)*self.dim_emb].contiguous()  # size(V_att_l)=(bsz, nb_nodes+1, dim_emb)
+            K_att_l = K_att[l] # size(K_att_l)=(bsz, nb_heads, nb_nodes+1, dim_emb//nb_heads)
+            V_att_l = V_att[l] # size(V_att_l)=(bsz, nb_heads, nb_nodes+1, dim_emb//nb_heads)
             if l<self.nb_layers_decoder-1: # decoder layers with multiple heads (intermediate layers)
                 h_t = self.decoder_layers[l](h_t, K_att_l, V_att_l, mask)
             else: # decoder layers with single head (final layer)
                 q_final = self.Wq_final(h_t)
-                bsz = h_t.size(0)
-                q_final = q_final.view(bsz, 1, self.dim_emb)
-                attn_weights = myMHA(q_final, K_att_l, V_att_l, 1, mask, 10)[1] 
-        prob_next_node = attn_weights.squeeze(1) 
-        return prob_next_node
+                q_final = q_final.view(bsz, B, self.dim_emb) # size(q_final)=(bsz, B, dim_emb)
+                # clipped attention logits, normalized with log-softmax instead of taking the log of the attention weights
+                logits = torch.bmm(q_final, K_att_l[:,0].transpose(1,2))/ self.dim_emb**0.5 # size(logits)=(bsz, B, nb_nodes+1)
+                logits = 10 * torch.tanh(logits)
+                logits = logits.masked_fill(mask.view(bsz, B, -1), float('-1e9')) # size(logits)=(bsz, B, nb_nodes+1)
+                log_prob_next_node = torch.log_softmax(logits.float(), dim=-1) # computed in float32, size(log_prob_next_node)=(bsz, B, nb_nodes+1)
+        log_prob_next_node = log_prob_next_node.view(bsz*B, -1) 
+        return log_prob_next_node
 
 
 def generate_positional_encoding(d_model, max_len):
@@ -280,11 +319,17 @@ class TSP_net(nn.Module):
     """
     
     def __init__(self, embedding, nb_neighbors, kernel_size, dim_input_nodes, dim_emb, dim_ff, nb_layers_encoder, nb_layers_decoder, nb_heads, max_len_PE,
-                 segm_len=None, batchnorm=True):
+                 segm_len=None, batchnorm=True, compile_encoder=False, mixed_precision=False, multi_query=False, compile_beam_search=False):
         super(TSP_net, self).__init__()
         
         self.dim_emb = dim_emb
         
+        # bfloat16 autocast of the forward pass on CUDA, and TF32 for the float32 matmuls and convolutions
+        self.mixed_precision = mixed_precision
+        if mixed_precision:
+            torch.backends.cuda.matmul.allow_tf32 = True
+            torch.backends.cudnn.allow_tf32 = True
+        
         # input embedding layer
         # self.input_emb = nn.Linear(dim_input_nodes, dim_emb)
         if embedding == 'linear':
@@ -300,25 +345,39 @@ class TSP_net(nn.Module):
         
         # encoder layer
         self.encoder = Transformer_encoder_net(nb_layers_encoder, dim_emb, nb_heads, dim_ff, batchnorm)
+        if compile_encoder:
+            # fuse the residual, normalization and feedforward kernels with torch.compile, compiled in-place to keep the checkpoint keys
+            # the decoder is not compiled, its self-attention keys and values change at every decoding step
+            self.encoder.compile()
+        # fuse the topk, index and gather kernels of each beam search step with torch.compile
+        self.compile_beam_search = compile_beam_search
         
         # vector to start decoding 
         self.start_placeholder = nn.Parameter(torch.randn(dim_emb))
         
         # decoder layer
-        self.decoder = Transformer_decoder_net(dim_emb, nb_heads, nb_layers_decoder, segm_len)
-        self.WK_att_decoder = nn.Linear(dim_emb, nb_layers_decoder* dim_emb) 
-        self.WV_att_decoder = nn.Linear(dim_emb, nb_layers_decoder* dim_emb) 
-        self.PE = generate_positional_encoding(dim_emb, max_len_PE)        
+        # multi_query shares a single self-attention key/value head across the query heads, reducing the decoder cache by nb_heads
+        self.decoder = Transformer_decoder_net(dim_emb, nb_heads, nb_layers_decoder, segm_len, multi_query)
+        self.WKV_att_decoder = nn.Linear(dim_emb, 2* nb_layers_decoder* dim_emb) # keys and values of query-attention in a single linear layer
+        # positional encoding, moved with the model by .to(device) and not saved in checkpoints
+        self.register_buffer('PE', generate_positional_encoding(dim_emb, max_len_PE), persistent=False) # size(PE)=(max_len_PE, dim_emb)
+        
+    # Load checkpoints saved with separate WK_att_decoder and WV_att_decoder layers
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        if prefix + 'WK_att_decoder.weight' in state_dict:
+            for name in ['weight', 'bias']:
+                state_dict[prefix + 'WKV_att_decoder.' + name] = torch.cat([state_dict.pop(prefix + W + '.' + name) for W in ['WK_att_decoder', 'WV_att_decoder']], dim=0)
+        super(TSP_net, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
         
     def forward(self, x, B, greedy, beamsearch):
+        with torch.autocast('cuda', dtype=torch.bfloat16, enabled=self.mixed_precision and x.is_cuda):
+            return self._forward(x, B, greedy, beamsearch)
+        
+    def _forward(self, x, B, greedy, beamsearch):
         
         # some parameters
         bsz = x.shape[0]
         nb_nodes = x.shape[1]
-        zero_to_bsz = torch.arange(bsz, device=x.device) # [0,1,...,bsz-1]
-        
-        # For beam search
-        zero_to_B = torch.arange(B, device=x.device) # [0,1,...,B-1]
 
         # input embedding layer
         h = self.input_emb(x) # size(h)=(bsz, nb_nodes, dim_emb)
@@ -330,11 +389,8 @@ class TSP_net(nn.Module):
         h_encoder, _ = self.encoder(h) # size(h)=(bsz, nb_nodes+1, dim_emb)
 
         # key and value for decoder    
-        K_att_decoder = self.WK_att_decoder(h_encoder) # size(K_att)=(bsz, nb_nodes+1, dim_emb*nb_layers_decoder)
-        V_att_decoder = self.WV_att_decoder(h_encoder) # size(V_att)=(bsz, nb_nodes+1, dim_emb*nb_layers_decoder)
-        
-        # starting node in tour
-        self.PE = self.PE.to(x.device)
+        K_att_decoder, V_att_decoder = self.WKV_att_decoder(h_encoder).chunk(2, dim=-1) # size(K_att)=size(V_att)=(bsz, nb_nodes+1, dim_emb*nb_layers_decoder)
+        K_att_decoder, V_att_decoder = self.decoder.split_keys_values(K_att_decoder, V_att_decoder) # lists of nb_layers_decoder tensors of size (bsz, nb_heads, nb_nodes+1, dim_emb//nb_heads)
         
         # For beam search
         tours_greedy = torch.zeros(2, nb_nodes, device=x.device)
@@ -346,43 +402,43 @@ class TSP_net(nn.Module):
         if greedy:
             #print('Greedy decoding')
             deterministic = True
-            # list that will contain Long tensors of shape (bsz,) that gives the idx of the cities chosen at time t
-            tours = []
-            # list that will contain Float tensors of shape (bsz,) that gives the neg log probs of the choices made at time t
-            sumLogProbOfActions = []
+            # tours[:,t] contains the idx of the cities chosen at time t, size(tours)=(bsz, nb_nodes)
+            tours = torch.empty(bsz, nb_nodes, dtype=torch.long, device=x.device)
+            # running sum of the log probs of the choices made up to time t, size(sumLogProbOfActions)=(bsz,)
+            sumLogProbOfActions = torch.zeros(bsz, device=x.device)
             # input placeholder that starts the decoding
-            idx_start_placeholder = torch.Tensor([nb_nodes]).long().repeat(bsz).to(x.device)
-            h_start = h_encoder[zero_to_bsz, idx_start_placeholder, :] + self.PE[0].repeat(bsz,1) # size(h_start)=(bsz, dim_emb)
+            h_start = h_encoder[:, nb_nodes, :] + self.PE[0] # size(h_start)=(bsz, dim_emb)
             # initialize mask of visited cities
             mask_visited_nodes = torch.zeros(bsz, nb_nodes+1, device=x.device).bool() # False
-            mask_visited_nodes[zero_to_bsz, idx_start_placeholder] = True
+            mask_visited_nodes[:, nb_nodes] = True
             # clear key and val stored in the decoder
-            self.decoder.reset_selfatt_keys_values()
+            self.decoder.reset_selfatt_keys_values(nb_nodes)
             # construct tour recursively
             h_t = h_start
             for t in range(nb_nodes):
-                # compute probability over the next node in the tour
-                prob_next_node = self.decoder(h_t, K_att_decoder, V_att_decoder, mask_visited_nodes) # size(prob_next_node)=(bsz, nb_nodes+1)
+                # compute log probability over the next node in the tour
+                log_prob_next_node = self.decoder(h_t, K_att_decoder, V_att_decoder, mask_visited_nodes) # size(log_prob_next_node)=(bsz, nb_nodes+1)
                 # choose node with highest probability or sample with Bernouilli 
                 if deterministic:
-                    idx = torch.argmax(prob_next_node, dim=1) # size(query)=(bsz,)
+                    idx = torch.argmax(log_prob_next_node, dim=1) # size(query)=(bsz,)
                 else:
-                    idx = Categorical(prob_next_node).sample() # size(query)=(bsz,)
-                # compute logprobs of the action items in the list sumLogProbOfActions   
-                ProbOfChoices = prob_next_node[zero_to_bsz, idx] 
-                sumLogProbOfActions.append( torch.log(ProbOfChoices) )  # size(query)=(bsz,)
+                    # Gumbel-max trick : argmax of the log probs perturbed by Gumbel noise is a sample of the distribution
+                    gumbel_noise = -torch.log(-torch.log(torch.rand_like(log_prob_next_node))) # size(gumbel_noise)=(bsz, nb_nodes+1)
+                    idx = torch.argmax(log_prob_next_node + gumbel_noise, dim=1) # size(query)=(bsz,)
+                # add the logprobs of the actions to sumLogProbOfActions
+                LogProbOfChoices = log_prob_next_node.gather(1, idx.unsqueeze(1)).squeeze(1) # size(LogProbOfChoices)=(bsz,)
+                sumLogProbOfActions += LogProbOfChoices # size(sumLogProbOfActions)=(bsz,)
                 # update embedding of the current visited node
-                h_t = h_encoder[zero_to_bsz, idx, :] # size(h_start)=(bsz, dim_emb)
-                h_t = h_t + self.PE[t+1].expand(bsz, self.dim_emb)
+                h_t = h_encoder.gather(1, idx.view(bsz, 1, 1).expand(bsz, 1, self.dim_emb)).squeeze(1) # size(h_t)=(bsz, dim_emb)
+                h_t.add_(self.PE[t+1]) # h_t is a fresh gather output, size(h_t)=(bsz, dim_emb)
                 # update tour
-                tours.append(idx)
+                tours[:,t] = idx
                 # update masks with visited nodes
-                mask_visited_nodes = mask_visited_nodes.clone()
-                mask_visited_nodes[zero_to_bsz, idx] = True
-            # logprob_of_choices = sum_t log prob( pi_t | pi_(t-1),...,pi_0 )
-            sumLogProbOfActions = torch.stack(sumLogProbOfActions,dim=1).sum(dim=1) # size(sumLogProbOfActions)=(bsz,)
-            # convert the list of nodes into a tensor of shape (bsz,num_cities)
-            tours = torch.stack(tours,dim=1) # size(col_index)=(bsz, nb_nodes)
+                if torch.is_grad_enabled():
+                    # the previous mask is saved for backward by masked_fill in the decoder, it must not be modified in-place
+                    mask_visited_nodes = mask_visited_nodes.clone()
+                mask_visited_nodes.scatter_(1, idx.unsqueeze(1), True) # size(mask_visited_nodes)=(bsz, nb_nodes+1)
+            # sumLogProbOfActions = sum_t log prob( pi_t | pi_(t-1),...,pi_0 )
             tours_greedy = tours
             scores_greedy = sumLogProbOfActions 
         
@@ -390,121 +446,53 @@ class TSP_net(nn.Module):
         if beamsearch:
             #print('Beam search decoding')
             # clear key and val stored in the decoder
-            self.decoder.reset_selfatt_keys_values() 
-            K_att_decoder_tmp = K_att_decoder # size(K_att_decoder_tmp)=(bsz, nb_nodes, dim_emb*nb_layers_decoder)
-            V_att_decoder_tmp = V_att_decoder # size(V_att_decoder_tmp)=(bsz, nb_nodes, dim_emb*nb_layers_decoder)
+            self.decoder.reset_selfatt_keys_values(nb_nodes) 
+            # the keys and values of query-attention are shared by the beams of a batch
+            # the beam update is compiled apart from the decoder, whose self-attention keys and values change at every step
+            beam_step = torch.compile(self._beam_step, dynamic=False) if self.compile_beam_search else self._beam_step
+            # output buffers of the top-B selection, reused at every step t>=1 when no graph is recorded
+            beam_buffers = None
+            if not torch.is_grad_enabled() and not self.compile_beam_search:
+                top_idx_buffer = torch.empty(bsz, B, dtype=torch.long, device=x.device)
+                beam_buffers = (torch.empty(bsz, B, device=x.device), top_idx_buffer, torch.empty_like(top_idx_buffer), torch.empty_like(top_idx_buffer))
             for t in range(nb_nodes):
                 #if not t%10:
                 #    print('t: {}, GPU reserved mem: {:.2f}, GPU allocated mem: {:.2f}'.format(t,torch.cuda.memory_reserved(0)/1e9,torch.cuda.memory_allocated(0)/1e9))
                 if t==0: # at t=0, there are at most B_{t=0}=nb_nodes beams
                     B_t0 = min(B, nb_nodes)
                     # input placeholder that starts the decoding
-                    idx_start_placeholder = torch.Tensor([nb_nodes]).long().repeat(bsz).to(x.device)
-                    h_start = h_encoder[zero_to_bsz, idx_start_placeholder, :] + self.PE[0].repeat(bsz,1) # size(h_start)=(bsz, dim_emb)
+                    h_start = h_encoder[:, nb_nodes, :] + self.PE[0] # size(h_start)=(bsz, dim_emb)
                     h_t = h_start # size(h_start)=(bsz, dim_emb)
                     mask_visited_nodes = torch.zeros(bsz, nb_nodes+1, device=x.device).bool() # False, size(mask_visited_nodes)=(bsz, nb_nodes+1) # initialize mask of visited cities
-                    mask_visited_nodes[zero_to_bsz, idx_start_placeholder] = True
-                    # compute probability over the next node in the tour
-                    prob_next_node = self.decoder(h_t, K_att_decoder, V_att_decoder, mask_visited_nodes) # size(prob_next_node)=(bsz, nb_nodes+1) 
+                    mask_visited_nodes[:, nb_nodes] = True
+                    # compute log probability over the next node in the tour
+                    log_prob_next_node = self.decoder(h_t, K_att_decoder, V_att_decoder, mask_visited_nodes) # size(log_prob_next_node)=(bsz, nb_nodes+1) 
                     # compute score_t + sum_t score_{t-1} for all beams
-                    score_t = torch.log(prob_next_node) # size(score_t)=(bsz, nb_nodes+1) for t=0 
+                    score_t = log_prob_next_node.float() # size(score_t)=(bsz, nb_nodes+1) for t=0, float32 accumulator
                     sum_scores = score_t # size(score_t)=(bsz, nb_nodes+1)
                     # choose nodes with top-B sumScores 
                     top_val, top_idx = torch.topk(sum_scores, B_t0, dim=1) # size(sumScores)=(bsz, B_t0)
                     # update sum_t score_{t} for all beams
                     sum_scores = top_val # size(sumScores)=(bsz, B_t0) 
-                    zero_to_B_t0 = torch.arange(B_t0, device=x.device) # [0,1,...,B_t0-1]
-                    mask_visited_nodes = mask_visited_nodes.unsqueeze(1) # size(mask_visited_nodes)=(bsz, 1, nb_nodes+1)
-                    mask_visited_nodes = torch.repeat_interleave(mask_visited_nodes, B_t0, dim=1)
-                    for b in range(bsz):
-                        mask_visited_nodes[b, zero_to_B_t0, top_idx[b]] = True # size(mask_visited_nodes)=(bsz, B_t0, nb_nodes+1)
-                    tours = torch.zeros(bsz, B_t0, nb_nodes, device=x.device).long() # size(tours)=(bsz, B_t0, nb_nodes)
+                    mask_visited_nodes = mask_visited_nodes.unsqueeze(1).expand(bsz, B_t0, nb_nodes+1).contiguous() # size(mask_visited_nodes)=(bsz, B_t0, nb_nodes+1)
+                    mask_visited_nodes.scatter_(2, top_idx.unsqueeze(2), True) # size(mask_visited_nodes)=(bsz, B_t0, nb_nodes+1)
+                    tours = torch.empty(bsz, B_t0, nb_nodes, dtype=torch.long, device=x.device) # size(tours)=(bsz, B_t0, nb_nodes)
                     tours[:,:,t] = top_idx # size(tours)=(bsz, B_t0, nb_nodes)
                     # update embedding of the current visited node
-                    h_t = torch.zeros(bsz, B_t0, self.dim_emb, device=x.device) # size(tours)=(bsz, B_t0, dim_emb)
-                    for b in range(bsz):
-                        h_t[b, :, :] = h_encoder[b, top_idx[b], :] # size(h_t)=(bsz, B_t0, dim_emb)
-                    h_t = h_t + self.PE[t+1].expand(bsz, B_t0, self.dim_emb) # size(h_t)=(bsz, B_t0, dim_emb)
+                    h_t = h_encoder.gather(1, top_idx.unsqueeze(2).expand(bsz, B_t0, self.dim_emb)) # size(h_t)=(bsz, B_t0, dim_emb)
+                    h_t.add_(self.PE[t+1]) # h_t is a fresh gather output, size(h_t)=(bsz, B_t0, dim_emb)
                     self.decoder.repeat_selfatt_keys_values(B_t0)
-                    K_att_decoder = torch.repeat_interleave(K_att_decoder_tmp, B_t0, dim=0) # size(K_att_decoder)=(bsz*B_t0, nb_nodes+1, dim_emb*nb_layers_decoder)
-                    V_att_decoder = torch.repeat_interleave(V_att_decoder_tmp, B_t0, dim=0) # size(V_att_decoder)=(bsz*B_t0, nb_nodes+1, dim_emb*nb_layers_decoder)
                     
-                elif t==1: # at t=1, there are at most B_{t=1}=nb_nodes^2 beams
-                    # compute probability over the next node in the tour
-                    h_t = h_t.view(bsz*B_t0, self.dim_emb)
-                    mask_visited_nodes = mask_visited_nodes.view(bsz*B_t0, nb_nodes+1)
-                    prob_next_node = self.decoder(h_t, K_att_decoder, V_att_decoder, mask_visited_nodes) # size(prob_next_node)=(bsz.B_t0, nb_nodes+1) 
-                    prob_next_node = prob_next_node.view(bsz, B_t0, nb_nodes+1) # size(prob_next_node)=(bsz, B_t0, nb_nodes+1) 
-                    mask_visited_nodes = mask_visited_nodes.view(bsz, B_t0, nb_nodes+1)
-                    h_t = h_t.view(bsz, B_t0, self.dim_emb) 
-                    # compute score_t + sum_t score_{t-1} for all beams
-                    score_t = torch.log(prob_next_node) # size(score_t)=(bsz, B, nb_nodes+1) 
-                    sum_scores = score_t + sum_scores.unsqueeze(2) # size(score_t)=(bsz, B, nb_nodes+1)
-                    sum_scores_flatten = sum_scores.view(bsz, -1) # size(sumScores_next_node)=(bsz, B.(nb_nodes+1))
-                    # choose nodes with top-B sumScores 
-                    top_val, top_idx = torch.topk(sum_scores_flatten, B, dim=1)
-                    idx_top_beams = top_idx // (nb_nodes+1) # size(idx_beam_topB)=(bsz, B)
-                    idx_in_beams = top_idx - idx_top_beams* (nb_nodes+1) # size(idx_in_beams)=(bsz, B)
-                    # update sum_t score_{t} for all beams
-                    sum_scores = top_val
-                    # update beam masks with visited nodes
-                    mask_visited_nodes_tmp = mask_visited_nodes.clone() # size(mask_visited_nodes_tmp)=(bsz, B_t0, nb_nodes+1)
-                    mask_visited_nodes = torch.zeros(bsz, B, nb_nodes+1, device=x.device).bool() # size(mask_visited_nodes)=(bsz, B, nb_nodes+1)
-                    for b in range(bsz):
-                        mask_visited_nodes[b, zero_to_B, :] = mask_visited_nodes_tmp[b, idx_top_beams[b], :] # size(mask_visited_nodes)=(bsz, B, nb_nodes+1)
-                    for b in range(bsz):
-                        mask_visited_nodes[b, zero_to_B, idx_in_beams[b]] = True # size(mask_visited_nodes)=(bsz, B, nb_nodes+1)
-                    # update beam tours with visited nodes
-                    tours_tmp = tours.clone()
-                    tours = torch.zeros(bsz, B, nb_nodes, device=x.device).long() # size(tours)=(bsz, B, nb_nodes)
-                    for b in range(bsz):
-                        tours[b, zero_to_B, :] = tours_tmp[b, idx_top_beams[b], :]
-                    tours[:,:,t] = idx_in_beams # size(tours)=(bsz, B, nb_nodes)
-                    # update embedding of the current visited node
-                    h_t = torch.zeros(bsz, B, self.dim_emb, device=x.device) # size(tours)=(bsz, B_t0, dim_emb)
-                    for b in range(bsz):
-                        h_t[b, :, :] = h_encoder[b, idx_in_beams[b], :] # size(h_t)=(bsz, B, dim_emb)
-                    h_t = h_t + self.PE[t+1].expand(bsz, B, self.dim_emb) # size(h_t)=(bsz, B, dim_emb)
-                    # update self-attention embeddings of partial tours
-                    self.decoder.reorder_selfatt_keys_values(t, idx_top_beams) # size(K_att_decoder)=(bsz*B_t0, nb_nodes+1, dim_emb*nb_layers_decoder)
-                    K_att_decoder = torch.repeat_interleave(K_att_decoder_tmp, B, dim=0) # size(K_att_decoder)=(bsz*B, nb_nodes+1, dim_emb*nb_layers_decoder)
-                    V_att_decoder = torch.repeat_interleave(V_att_decoder_tmp, B, dim=0) # size(V_att_decoder)=(bsz*B, nb_nodes+1, dim_emb*nb_layers_decoder)
-
-                else: # at t>=2, we arbitrary decide to have at most B_{t>=2}=nb_nodes^2 beams
-                    # compute probability over the next node in the tour
-                    h_t = h_t.view(bsz*B, self.dim_emb)
-                    mask_visited_nodes = mask_visited_nodes.view(bsz*B, nb_nodes+1)
-                    prob_next_node = self.decoder(h_t, K_att_decoder, V_att_decoder, mask_visited_nodes) # size(prob_next_node)=(bsz.B, nb_nodes+1) 
-                    prob_next_node = prob_next_node.view(bsz, B, nb_nodes+1) # size(prob_next_node)=(bsz, B, nb_nodes+1) 
-                    mask_visited_nodes = mask_visited_nodes.view(bsz, B, nb_nodes+1)
-                    h_t = h_t.view(bsz, B, self.dim_emb) 
-                    # compute score_t + sum_t score_{t-1} for all beams
-                    score_t = torch.log(prob_next_node) # size(score_t)=(bsz, B, nb_nodes+1)
-                    sum_scores = score_t + sum_scores.unsqueeze(2) # size(score_t)=(bsz, B, nb_nodes+1)
-                    sum_scores_flatten = sum_scores.view(bsz, -1) # size(sumScores_next_node)=(bsz, B.(nb_nodes+1))
-                    # choose nodes with top-B sumScores 
-                    top_val, top_idx = torch.topk(sum_scores_flatten, B, dim=1)
-                    idx_top_beams = top_idx // (nb_nodes+1) # size(idx_beam_topB)=(bsz, B)
-                    idx_in_beams = top_idx - idx_top_beams* (nb_nodes+1) # size(idx_in_beams)=(bsz, B)
-                    # update sum_t score_{t} for all beams
-                    sum_scores = top_val
-                    # update beam masks with visited nodes
-                    mask_visited_nodes_tmp = mask_visited_nodes.clone()
-                    for b in range(bsz):
-                        mask_visited_nodes[b, zero_to_B, :] = mask_visited_nodes_tmp[b, idx_top_beams[b], :]
-                    for b in range(bsz):
-                        mask_visited_nodes[b, zero_to_B, idx_in_beams[b]] = True
-                    # update beam tours with visited nodes
-                    tours_tmp = tours.clone()
-                    for b in range(bsz):
-                        tours[b, zero_to_B, :] = tours_tmp[b, idx_top_beams[b], :]
+                else: # at t>=1, we arbitrary decide to have at most B_{t>=1}=B beams
+                    # compute log probability over the next node in the tour
+                    B_t = h_t.size(1) # B_t0 at t=1, B at t>=2
+                    log_prob_next_node = self.decoder(h_t.view(bsz*B_t, self.dim_emb), K_att_decoder, V_att_decoder, mask_visited_nodes.view(bsz*B_t, nb_nodes+1)) # size(log_prob_next_node)=(bsz.B_t, nb_nodes+1) 
+                    log_prob_next_node = log_prob_next_node.view(bsz, B_t, nb_nodes+1) # size(log_prob_next_node)=(bsz, B_t, nb_nodes+1) 
+                    # select the top-B beams and update their states
+                    h_t, mask_visited_nodes, sum_scores, tours, idx_top_beams, idx_in_beams = beam_step(h_encoder, log_prob_next_node, mask_visited_nodes, sum_scores, tours, self.PE[t+1], B, beam_buffers)
                     tours[:,:,t] = idx_in_beams # size(tours)=(bsz, B, nb_nodes)
-                    # update embedding of the current visited node
-                    for b in range(bsz):
-                        h_t[b, :, :] = h_encoder[b, idx_in_beams[b], :] # size(h_t)=(bsz, B, dim_emb)
-                    h_t = h_t + self.PE[t+1].expand(bsz, B, self.dim_emb) # size(h_t)=(bsz, B, dim_emb)
                     # update self-attention embeddings of partial tours
-                    self.decoder.reorder_selfatt_keys_values(t, idx_top_beams)
+                    self.decoder.reorder_selfatt_keys_values(idx_top_beams)
             # sum_t log prob( pi_t | pi_0,...pi_(t-1) )
             sum_scores = sum_scores[:,0] # size(sumScores)=(bsz)
             tours_beamsearch = tours
@@ -512,14 +500,88 @@ class TSP_net(nn.Module):
 
         return tours_greedy, tours_beamsearch, scores_greedy, scores_beamsearch
 
+    def _beam_step(self, h_encoder, log_prob_next_node, mask_visited_nodes, sum_scores, tours, PE_t, B, out=None):
+        """
+        One beam search update at t>=1 : select the top-B partial tours and gather their states
+        Inputs : h_encoder of size (bsz, nb_nodes+1, dim_emb)
+                 log_prob_next_node of size (bsz, B_t, nb_nodes+1)
+                 mask_visited_nodes of size (bsz, B_t, nb_nodes+1)
+                 sum_scores of size (bsz, B_t)
+                 tours of size (bsz, B_t, nb_nodes)
+                 PE_t of size (dim_emb,) positional encoding of the next step
+                 out is None or a tuple of buffers (top_val, top_idx, idx_top_beams, idx_in_beams) of size (bsz, B), only without autograd
+        Outputs : h_t of size (bsz, B, dim_emb), mask_visited_nodes of size (bsz, B, nb_nodes+1), sum_scores of size (bsz, B)
+                  tours of size (bsz, B, nb_nodes) whose column t is left to the caller
+                  idx_top_beams, idx_in_beams of size (bsz, B) parent beam and chosen node of each new beam
+        """
+        bsz, nb_nodes = tours.size(0), tours.size(2)
+        # compute score_t + sum_t score_{t-1} for all beams
+        score_t = log_prob_next_node.float() # size(score_t)=(bsz, B_t, nb_nodes+1), accumulated in float32 to keep the beam ranking stable under autocast
+        sum_scores = score_t + sum_scores.unsqueeze(2) # size(score_t)=(bsz, B_t, nb_nodes+1)
+        sum_scores_flatten = sum_scores.view(bsz, -1) # size(sumScores_next_node)=(bsz, B_t.(nb_nodes+1))
+        # choose nodes with top-B sumScores 
+        if out is None:
+            top_val, top_idx = torch.topk(sum_scores_flatten, B, dim=1)
+            idx_top_beams = torch.div(top_idx, nb_nodes+1, rounding_mode='floor') # size(idx_beam_topB)=(bsz, B)
+            idx_in_beams = torch.remainder(top_idx, nb_nodes+1) # size(idx_in_beams)=(bsz, B)
+        else: # overwrite the buffers of the previous step, which have all been consumed
+            top_val, top_idx, idx_top_beams, idx_in_beams = out
+            torch.topk(sum_scores_flatten, B, dim=1, out=(top_val, top_idx))
+            torch.div(top_idx, nb_nodes+1, rounding_mode='floor', out=idx_top_beams) # size(idx_beam_topB)=(bsz, B)
+            torch.remainder(top_idx, nb_nodes+1, out=idx_in_beams) # size(idx_in_beams)=(bsz, B)
+        # update sum_t score_{t} for all beams
+        sum_scores = top_val
+        # update beam masks with visited nodes
+        mask_visited_nodes = mask_visited_nodes.gather(1, idx_top_beams.unsqueeze(2).expand(bsz, B, nb_nodes+1)) # size(mask_visited_nodes)=(bsz, B, nb_nodes+1)
+        mask_visited_nodes.scatter_(2, idx_in_beams.unsqueeze(2), True) # size(mask_visited_nodes)=(bsz, B, nb_nodes+1)
+        # update beam tours with visited nodes
+        tours = tours.gather(1, idx_top_beams.unsqueeze(2).expand(bsz, B, nb_nodes)) # size(tours)=(bsz, B, nb_nodes)
+        # update embedding of the current visited node
+        h_t = h_encoder.gather(1, idx_in_beams.unsqueeze(2).expand(bsz, B, self.dim_emb)) # size(h_t)=(bsz, B, dim_emb)
+        h_t.add_(PE_t) # h_t is a fresh gather output, size(h_t)=(bsz, B, dim_emb)
+        return h_t, mask_visited_nodes, sum_scores, tours, idx_top_beams, idx_in_beams
+
+def _pairwise_sqdist(x):
+    """
+    Squared distances |x_i|^2 + |x_j|^2 - 2 x_i.x_j with a single batched matmul, in float32 even under autocast
+    :param Tensor x: (B, N, 2)
+    :return Tensor sqdist_matrix: (B, N, N)
+    """
+    with torch.autocast(x.device.type, enabled=False):
+        x = x.float()
+        xx = x.pow(2).sum(-1, keepdim=True)  # (B, N, 1)
+        return torch.baddbmm(xx + xx.transpose(1, 2), x, x.transpose(1, 2), alpha=-2).clamp_min_(0)  # (B, N, N)
+
+def _build_knn(x, nb_neighbors):
+    """
+    :param Tensor x: (B, N, 2)
+    :param int nb_neighbors: K
+    :return Tensor knn_coords: (B, N, 2, K+1) coords of the k-NN of each node including itself, farthest first,
+                               laid out with the neighbors innermost as the conv reads them
+    """
+    bsz, seq_len = x.size(0), x.size(1)
+    sqdist_matrix = _pairwise_sqdist(x)  # (B, N, N) squared distances, no sqrt needed for ranking
+    knn_indices = sqdist_matrix.topk(nb_neighbors+1, dim=-1, largest=False)[1].flip(-1)  # (B, N, K+1) including itself, farthest first
+    idx = knn_indices.unsqueeze(2).expand(bsz, seq_len, 2, nb_neighbors+1)  # (B, N, 2, K+1)
+    knn_coords = x.transpose(1, 2).unsqueeze(1).expand(bsz, seq_len, 2, seq_len).gather(3, idx)  # (B, N, 2, K+1), contiguous
+    return knn_coords
+
 class ConvEmbedding(nn.Module):
     def __init__(self, nb_neighbors, kernel_size, dim_emb, dim_input_nodes):
         super().__init__()
         self.nb_neighbors = nb_neighbors
-        self.conv = nn.Conv1d(in_channels=dim_input_nodes, out_channels=dim_emb, kernel_size=kernel_size)
+        self.conv = nn.Conv1d(in_channels=dim_input_nodes, out_channels=dim_emb, kernel_size=kernel_size, bias=False)
+        bound = 1 / math.sqrt(dim_input_nodes * kernel_size)  # default init of the Conv1d bias
+        self.conv_bias = nn.Parameter(torch.empty(dim_emb).uniform_(-bound, bound))  # added once to the (B, N, H) output
         self.W1 = nn.Linear(dim_input_nodes, dim_emb)  # for node x_i
         self.W2 = nn.Linear(dim_emb, dim_emb)  # for convolved node feature hbar_i
 
+    # Load checkpoints saved with the bias inside the conv
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        if prefix + 'conv.bias' in state_dict:
+            state_dict[prefix + 'conv_bias'] = state_dict.pop(prefix + 'conv.bias')
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
     def forward(self, x):
         """
         :param Tensor x: (B, N, 2)
@@ -529,28 +591,25 @@ class ConvEmbedding(nn.Module):
 
         node_embedding = self.W1(x)  # (B, N, H)
 
-        # Make k-NN for each node (B, N, K+1, 2)
-        dist_matrix = torch.cdist(x, x)  # (B, N, N)
-        # knn_indices = dist_matrix.topk(self.nb_neighbors+1)[1]  # (B, N, K+1) including itself
-        knn_indices = dist_matrix.topk(k=seq_len)[1][:,:,-self.nb_neighbors-1:]  # (B, N, K+1) including itself
-        embedding_list = []
-        for i in range(seq_len):
-            idx = knn_indices[:, i, :].unsqueeze(2).repeat(1,1,2)  # (B, K+1, 2)
-            knn_coords = x.gather(1, idx)
-
-            knn_coords = knn_coords.permute(0, 2, 1)  # (B, 2, K+1)
-            conv_embedding = self.conv(knn_coords)  # (B, H, 1)
-            
-            conv_embedding = conv_embedding.permute(0, 2, 1)  # (B, 1, H)
-            # conv_embedding = self.W2(conv_embedding)  # (B, 1, H)  comment
+        # Make k-NN for each node (B, N, 2, K+1) and convolve them as a batch of B*N windows
+        knn_coords = _build_knn(x, self.nb_neighbors).view(bsz*seq_len, 2, -1)  # (B*N, 2, K+1)
+        conv_embedding = self.conv(knn_coords)  # (B*N, H, 1)
 
-            embedding_list.append(conv_embedding)
-        conv_embedding = torch.cat(embedding_list, dim=1)  # (B, N, H)
-        conv_embedding = self.W2(conv_embedding)  # (B, N, H)  namely CEFix
+        conv_embedding = conv_embedding.permute(0, 2, 1).reshape(bsz, -1, conv_embedding.size(1))  # (B, N, H)
+        conv_embedding = self.W2(conv_embedding + self.conv_bias)  # (B, N, H)  namely CEFix
 
         final_embedding = node_embedding + conv_embedding  # (B, N, H)
         return final_embedding
 
+    @torch.no_grad()
+    def fuse_w2(self):
+        """
+        Fold W2 into the conv, W2(conv(x)) being itself a conv. Call it after loading the weights, for inference
+        """
+        self.conv.weight.copy_(torch.einsum('ho,oik->hik', self.W2.weight, self.conv.weight))  # (H, 2, kernel_size)
+        self.conv_bias.copy_(self.W2(self.conv_bias))  # (H,)
+        self.W2 = nn.Identity()
+
 class ConvSamePadding(nn.Module):
     def __init__(self, dim_input_nodes, dim_emb, kernel_size):
         super().__init__()
@@ -581,25 +640,18 @@ class ConvEmbeddingXY(nn.Module):
     def __init__(self, nb_neighbors, kernel_size, dim_emb, dim_input_nodes):
         super().__init__()
         self.nb_neighbors = nb_neighbors
-        self.conv_x = nn.Conv1d(in_channels=dim_input_nodes, out_channels=dim_emb, kernel_size=kernel_size)
-        self.conv_y = nn.Conv1d(in_channels=dim_input_nodes, out_channels=dim_emb, kernel_size=kernel_size)
+        self.conv_x = nn.Conv1d(in_channels=dim_input_nodes, out_channels=dim_emb, kernel_size=kernel_size, bias=False)
+        self.conv_y = nn.Conv1d(in_channels=dim_input_nodes, out_channels=dim_emb, kernel_size=kernel_size, bias=False)
+        bound = 1 / math.sqrt(dim_input_nodes * kernel_size)  # default init of the Conv1d bias
+        self.conv_bias = nn.Parameter(torch.empty(dim_emb).uniform_(-bound, bound))  # bias of conv_x + conv_y, added once
         self.W1 = nn.Linear(dim_input_nodes, dim_emb)  # for node x_i
         self.W2 = nn.Linear(dim_emb, dim_emb)  # for convolved node feature hbar_i
     
-    def _sort_by_xy(self, coord):
-        """
-        :param Tensor coord: (B, K, 2)
-        """
-        toB = torch.arange(coord.size(0))
-        indices = coord[:, :, 0].argsort()  # sort by x coordinate (B, K)
-        coord = coord[toB.unsqueeze(1), indices]  # (B, K, 2)
-        return coord
-    
-    def _sort_by_yx(self, coord):
-        toB = torch.arange(coord.size(0))
-        indices = coord[:, :, 1].argsort()  # sort by y coordinate
-        coord = coord[toB.unsqueeze(1), indices]
-        return coord
+    # Load checkpoints saved with the biases inside conv_x and conv_y
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        if prefix + 'conv_x.bias' in state_dict:
+            state_dict[prefix + 'conv_bias'] = state_dict.pop(prefix + 'conv_x.bias') + state_dict.pop(prefix + 'conv_y.bias')
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
     def forward(self, x):
         """
@@ -610,55 +662,72 @@ class ConvEmbeddingXY(nn.Module):
 
         node_embedding = self.W1(x)  # (B, N, H)
 
-        # Make k-NN for each node (B, N, K+1, 2)
-        dist_matrix = torch.cdist(x, x)  # (B, N, N)
-        knn_indices = dist_matrix.topk(k=seq_len)[1][:,:,-self.nb_neighbors-1:]  # (B, N, K+1) including itself
-
-        embedding_list = []
-        for i in range(seq_len):
-            idx = knn_indices[:, i, :].unsqueeze(2).repeat(1,1,2)  # (B, K+1, 2)
-            knn_coords = x.gather(1, idx)
+        # Make k-NN for each node (B, N, 2, K+1) and convolve them as a batch of B*N windows
+        knn_coords = _build_knn(x, self.nb_neighbors).view(bsz*seq_len, 2, -1)  # (B*N, 2, K+1)
 
-            knn_coords_x = self._sort_by_xy(knn_coords)  # (B, K+1, 2)
-            knn_coords_y = self._sort_by_yx(knn_coords)  # (B, K+1, 2)
+        # Sort each window by x and by y coordinate with a single argsort
+        sort_indices = knn_coords.argsort(dim=2)  # (B*N, 2, K+1), x order in row 0 and y order in row 1
+        knn_coords_x = knn_coords.gather(2, sort_indices[:, 0:1, :].expand_as(knn_coords))  # (B*N, 2, K+1)
+        knn_coords_y = knn_coords.gather(2, sort_indices[:, 1:2, :].expand_as(knn_coords))  # (B*N, 2, K+1)
 
-            knn_coords_x = knn_coords_x.permute(0, 2, 1)  # (B, 2, K+1)
-            conv_embedding_x = self.conv_x(knn_coords_x)  # (B, H, 1)
-            
-            knn_coords_y = knn_coords_y.permute(0, 2, 1)  # (B, 2, K+1)
-            conv_embedding_y = self.conv_y(knn_coords_y)  # (B, H, 1)
+        conv_embedding_x = self.conv_x(knn_coords_x)  # (B*N, H, 1)
 
-            conv_embedding = conv_embedding_x + conv_embedding_y  # (B, H, 1)
+        conv_embedding_y = self.conv_y(knn_coords_y)  # (B*N, H, 1)
 
-            conv_embedding = conv_embedding.permute(0, 2, 1)  # (B, 1, H)
-            # conv_embedding = self.W2(conv_embedding)  # (B, 1, H)
+        conv_embedding = conv_embedding_x + conv_embedding_y  # (B*N, H, 1)
 
-            embedding_list.append(conv_embedding)
-        conv_embedding = torch.cat(embedding_list, dim=1)  # (B, N, H)
-        conv_embedding = self.W2(conv_embedding)  # (B, N, H)  namely CEFix
+        conv_embedding = conv_embedding.permute(0, 2, 1).reshape(bsz, -1, conv_embedding.size(1))  # (B, N, H)
+        conv_embedding = self.W2(conv_embedding + self.conv_bias)  # (B, N, H)  namely CEFix
 
         final_embedding = node_embedding + conv_embedding  # (B, N, H)
         return final_embedding
+
+    @torch.no_grad()
+    def fuse_w2(self):
+        """
+        Fold W2 into conv_x and conv_y, W2(conv_x(x)+conv_y(y)+b) = W2.weight conv_x(x) + W2.weight conv_y(y) + W2(b).
+        Call it after loading the weights, for inference
+        """
+        for conv in [self.conv_x, self.conv_y]:
+            conv.weight.copy_(torch.einsum('ho,oik->hik', self.W2.weight, conv.weight))  # (H, 2, kernel_size)
+        self.conv_bias.copy_(self.W2(self.conv_bias))  # (H,)
+        self.W2 = nn.Identity()
      
-def compute_tour_length(x, tour): 
+if numba is not None:
+    @numba.njit(parallel=True, fastmath=True)
+    def _tour_length_cpu(x, tour):
+        """
+        compute_tour_length in a single parallel loop over the batch, for numpy arrays
+        x of size (bsz, nb_nodes, 2) float32, tour of size (bsz, nb_nodes) int64
+        """
+        bsz, nb_nodes = tour.shape
+        L = np.empty(bsz, dtype=np.float32) # size(L)=(bsz,)
+        for b in numba.prange(bsz):
+            first_x, first_y = x[b, tour[b,0], 0], x[b, tour[b,0], 1]
+            previous_x, previous_y = first_x, first_y
+            length = 0.0
+            for i in range(1, nb_nodes):
+                current_x, current_y = x[b, tour[b,i], 0], x[b, tour[b,i], 1]
+                length += math.sqrt((current_x - previous_x)**2 + (current_y - previous_y)**2)
+                previous_x, previous_y = current_x, current_y
+            length += math.sqrt((first_x - previous_x)**2 + (first_y - previous_y)**2)
+            L[b] = length
+        return L
+
+def compute_tour_length(x, tour, use_numba=False): 
     """
     Compute the length of a batch of tours
     Inputs : x of size (bsz, nb_nodes, 2) batch of tsp tour instances
              tour of size (bsz, nb_nodes) batch of sequences (node indices) of tsp tours
+             use_numba is a boolean : If True and numba is installed, CPU tensors go through a compiled loop,
+                                      worth its first-call compilation time only when called many times
     Output : L of size (bsz,)             batch of lengths of each tsp tour
     """
-    bsz = x.shape[0]
-    nb_nodes = x.shape[1]
-    arange_vec = torch.arange(bsz, device=x.device)
-    first_cities = x[arange_vec, tour[:,0], :] # size(first_cities)=(bsz,2)
-    previous_cities = first_cities
-    L = torch.zeros(bsz, device=x.device)
-    with torch.no_grad():
-        for i in range(1,nb_nodes):
-            current_cities = x[arange_vec, tour[:,i], :] 
-            L += (current_cities - previous_cities).pow(2).sum(dim=1).sqrt()
-            # L += torch.sum( torch.round((current_cities - previous_cities)**2) , dim=1 )**0.5 # dist(current, previous node) 
-            previous_cities = current_cities
-        L += (current_cities - first_cities).pow(2).sum(dim=1).sqrt()
-        # L += torch.sum( torch.round((current_cities - first_cities)**2) , dim=1 )**0.5 # dist(last, first node)  
+    if use_numba and numba is not None and x.device.type == 'cpu':
+        # one compiled loop instead of a few tensor ops whose dispatch overhead dominates on CPU
+        return torch.from_numpy(_tour_length_cpu(x.detach().float().contiguous().numpy(), tour.long().contiguous().numpy()))
+    with torch.no_grad(), torch.autocast(x.device.type, enabled=False):
+        cities = x.float().gather(1, tour.unsqueeze(2).expand(-1, -1, 2)) # size(cities)=(bsz, nb_nodes, 2), cities in tour order, in float32
+        # dist(node i, node i+1) for all i, rolling back to the first node closes the tour
+        L = (cities - cities.roll(-1, dims=1)).pow(2).sum(dim=2).sqrt().sum(dim=1) # size(L)=(bsz,)
     return L
\ No newline at end of file